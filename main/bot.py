@@ -1,26 +1,70 @@
 # ./app/bot.py
 
+import asyncio
+import hashlib
 import random
-import pickle
+import re
+import tempfile
+import joblib
+import numpy as np
 import os
 import logging
 import traceback
+from collections import defaultdict
 from enum import Enum
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 import speech_recognition as sr
+import uvloop
 from gtts import gTTS
 from pydub import AudioSegment
 from dotenv import load_dotenv
 from config import CONFIG
-from sklearn.metrics.pairwise import cosine_similarity
 from utils import clear_phrase, is_meaningful_text, extract_car_name, extract_car_category, extract_price, \
 Stats, logger, lemmatize_phrase, analyze_sentiment
 from rapidfuzz import process, fuzz
 
+# Кэшированные обёртки над NLP-функциями: одна и та же реплика обрабатывается за ход несколько раз
+_lem = lru_cache(maxsize=8192)(lemmatize_phrase)
+_senti = lru_cache(maxsize=8192)(analyze_sentiment)
+_car_of = lru_cache(maxsize=8192)(extract_car_name)
+_category_of = lru_cache(maxsize=8192)(extract_car_category)
+
+# Подстановка значений в шаблоны ответов вида '[car_name]' за один проход
+_PLACEHOLDER_RE = re.compile(r'\[(\w+)\]')
+
+def _fill(template, subs):
+    """Заменяет плейсхолдеры шаблона значениями из subs, неизвестные оставляет как есть."""
+    return _PLACEHOLDER_RE.sub(lambda m: subs.get(m.group(1), m.group(0)), template)
+
+# Добавка к ответу по тональности
+def _suffix(sentiment, positive, negative):
+    """Возвращает добавку к ответу в зависимости от тональности."""
+    if sentiment == 'positive':
+        return positive
+    if sentiment == 'negative':
+        return negative
+    return ""
+
 # Загрузка токена
 load_dotenv()
 TOKEN = os.getenv('TELEGRAM_TOKEN')
+# Публичный адрес для webhook; если не задан, бот работает через polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+# Сколько обновлений обрабатывается одновременно. PTB не упорядочивает обновления одного чата,
+# и два сообщения пользователя могли бы завершиться в обратном порядке; это исключает блокировка
+# чата (_chat_lock), поэтому параллельно обрабатываются только разные чаты
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 16))
+
+# Таймаут распознавания речи, секунды
+VOICE_TIMEOUT = 5
+
+# Кэш синтезированных ответов
+TTS_CACHE_DIR = Path('cache/tts')
 
 # Состояния бота
 class BotState(Enum):
@@ -54,21 +98,65 @@ class Bot:
     def __init__(self):
         """Инициализация моделей."""
         try:
-            with open('models/intent_model.pkl', 'rb') as f:
-                self.clf = pickle.load(f)
-            with open('models/intent_vectorizer.pkl', 'rb') as f:
-                self.vectorizer = pickle.load(f)
-            with open('models/dialogues_vectorizer.pkl', 'rb') as f:
-                self.tfidf_vectorizer = pickle.load(f)
-            with open('models/dialogues_matrix.pkl', 'rb') as f:
-                self.tfidf_matrix = pickle.load(f)
-            with open('models/dialogues_answers.pkl', 'rb') as f:
-                self.answers = pickle.load(f)
+            # Модель намерений нужна только как запасной вариант, когда по примерам ничего не нашлось
+            self.clf = None
+            self.vectorizer = None
+            if CONFIG['intent_classifier_fallback']:
+                self.clf = joblib.load('models/intent_model.pkl')
+                self.vectorizer = joblib.load('models/intent_vectorizer.pkl')
+            # Числовые массивы отображаются в память только для чтения: процессы бота делят одни страницы
+            self.tfidf_vectorizer = joblib.load('models/dialogues_vectorizer.pkl', mmap_mode='r')
+            self.tfidf_matrix = joblib.load('models/dialogues_matrix.pkl', mmap_mode='r')
+            self.answers = joblib.load('models/dialogues_answers.pkl')
         except FileNotFoundError as e:
             logger.error(f"Не найдены файлы модели: {e}\n{traceback.format_exc()}")
             raise
 
-    def _update_context(self, context, replica, answer, intent=None):
+        # Лемматизированные примеры намерений (считаются один раз)
+        self.intent_examples = {
+            intent_key: [lem for ex in data.get('examples', []) if (lem := lemmatize_phrase(ex))]
+            for intent_key, data in CONFIG['intents'].items() if data.get('examples')
+        }
+        # Плоский список примеров и параллельный список их намерений для одного прохода rapidfuzz
+        self._flat_examples = []
+        self._example_to_intent = []
+        for intent_key, examples in self.intent_examples.items():
+            self._flat_examples.extend(examples)
+            self._example_to_intent.extend([intent_key] * len(examples))
+
+        # Быстрый путь: однозначные короткие реплики (да/нет/привет/пока) сопоставляются без классификации
+        self._keyword_to_intent = {}
+        for intent_key in CONFIG['fast_intents']:
+            for ex in CONFIG['intents'].get(intent_key, {}).get('examples', []):
+                keyword = ' '.join(clear_phrase(ex).split())
+                if keyword:
+                    self._keyword_to_intent.setdefault(keyword, intent_key)
+
+        # Индекс по автомобилям: категория -> машины
+        self.cars_by_category = defaultdict(list)
+        for car, data in CONFIG['cars'].items():
+            for category in data.get('categories', []):
+                self.cars_by_category[category].append(car)
+        self._car_keys = tuple(CONFIG['cars'])
+        self._unique_categories = tuple(dict.fromkeys(
+            category for data in CONFIG['cars'].values() for category in data.get('categories', [])))
+
+        # Каталог в виде массивов (имена, цены, маски категорий) для векторной фильтрации
+        self._car_names = np.array(self._car_keys, dtype=object)
+        self._car_prices = np.array([CONFIG['cars'][car]['price'] for car in self._car_keys], dtype=np.int64)
+        self._car_category_mask = {
+            category: np.array([car in self.cars_by_category[category] for car in self._car_keys], dtype=bool)
+            for category in self._unique_categories
+        }
+
+    def _random_car(self, exclude=None):
+        """Выбирает случайную машину, отличную от exclude, без построения отфильтрованного списка."""
+        car = random.choice(self._car_keys)
+        while car == exclude and len(self._car_keys) > 1:
+            car = random.choice(self._car_keys)
+        return car
+
+    def _update_context(self, context, replica, answer, intent=None, car_name=None, car_category=None):
         """Обновляет контекст пользователя."""
         context.user_data.setdefault('state', BotState.NONE.value)
         context.user_data.setdefault('current_car', None)
@@ -76,7 +164,8 @@ class Bot:
         context.user_data.setdefault('last_intent', None)
         context.user_data.setdefault('history', [])
 
-        context.user_data['history'].append(replica)
+        # Машина и категория сохраняются вместе с репликой, чтобы не извлекать их заново при поиске по истории
+        context.user_data['history'].append({'text': replica, 'car': car_name, 'category': car_category})
         context.user_data['history'] = context.user_data['history'][-CONFIG['history_limit']:]
         context.user_data['last_bot_response'] = answer
         if intent:
@@ -84,24 +173,27 @@ class Bot:
 
     def classify_intent(self, replica):
         """Классифицирует намерение пользователя."""
-        replica_lemmatized = lemmatize_phrase(replica)
+        intent = self._keyword_to_intent.get(' '.join(clear_phrase(replica).split()))
+        if intent:
+            return intent
+        replica_lemmatized = _lem(replica)
         if not replica_lemmatized:
             return None
-        vectorized = self.vectorizer.transform([replica_lemmatized])
-        intent = self.clf.predict(vectorized)[0]
-        best_score = 0
-        best_intent = None
-        for intent_key, data in CONFIG['intents'].items():
-            examples = [lemmatize_phrase(ex) for ex in data.get('examples', []) if lemmatize_phrase(ex)]
-            if not examples:
-                continue
-            match = process.extractOne(replica_lemmatized, examples, scorer=fuzz.ratio)
-            if match and match[1] / 100 > best_score and match[1] / 100 >= CONFIG['thresholds']['intent_score']:
-                best_score = match[1] / 100
-                best_intent = intent_key
+        match = process.extractOne(replica_lemmatized, self._flat_examples, scorer=fuzz.ratio,
+                                   score_cutoff=CONFIG['thresholds']['intent_score'] * 100)
+        best_score = match[1] / 100 if match else 0
+        best_intent = self._example_to_intent[match[2]] if match else None
+        intent = None
+        if best_intent is None and self.clf is not None:
+            # LinearSVC всегда возвращает метку, поэтому принимаем её только при уверенном отрыве,
+            # иначе реплика уходит в диалоги или фразу неудачи
+            scores = self.clf.decision_function(self.vectorizer.transform([replica_lemmatized]))[0]
+            best_class = scores.argmax()
+            if scores[best_class] >= CONFIG['thresholds']['intent_classifier_margin']:
+                intent = self.clf.classes_[best_class]
         logger.info(
             f"Classify intent: replica='{replica_lemmatized}', predicted='{intent}', best_intent='{best_intent}', score={best_score}")
-        return best_intent or intent if best_score >= CONFIG['thresholds']['intent_score'] else None
+        return best_intent or intent
 
     def _get_car_response(self, intent, car_name, replica, context):
         """Обрабатывает запросы, связанные с конкретным автомобилем."""
@@ -110,15 +202,14 @@ class Bot:
         responses = CONFIG['intents'][intent]['responses']
         answer = random.choice(responses)
         car_data = CONFIG['cars'][car_name]
-        answer = answer.replace('[car_name]', car_name)
-        answer = answer.replace('[price]', str(car_data['price']))
-        answer = answer.replace('[description]', car_data.get('description', 'отличный автомобиль'))
+        answer = _fill(answer, {
+            'car_name': car_name,
+            'price': str(car_data['price']),
+            'description': car_data.get('description', 'отличный автомобиль'),
+        })
 
-        sentiment = analyze_sentiment(replica)
-        if sentiment == 'positive':
-            answer += " Рад, что вам нравится! 😊"
-        elif sentiment == 'negative':
-            answer += " Кажется, вы сомневаетесь. Может, тест-драйв поможет? 😊"
+        answer += _suffix(_senti(replica), " Рад, что вам нравится! 😊",
+                          " Кажется, вы сомневаетесь. Может, тест-драйв поможет? 😊")
 
         return f"{answer} Что ещё интересует?"
 
@@ -126,35 +217,32 @@ class Bot:
         """Ищет автомобиль на основе контекста или категории."""
         last_response = context.user_data.get('last_bot_response', '')
         last_intent = context.user_data.get('last_intent', '')
-        car_category = extract_car_category(replica)
+        car_category = _category_of(replica)
 
         if last_response and 'Кстати, у нас есть' in last_response:
-            return extract_car_name(last_response)
+            return _car_of(last_response)
         elif car_category:
-            suitable_cars = [car for car, data in CONFIG['cars'].items() if car_category in data.get('categories', [])]
+            suitable_cars = self.cars_by_category.get(car_category, ())
             return random.choice(suitable_cars) if suitable_cars else None
         elif last_intent == Intent.CAR_TYPES.value:
             for hist in context.user_data.get('history', [])[::-1]:
-                hist_car = extract_car_name(hist)
-                if hist_car:
-                    return hist_car
-                hist_category = extract_car_category(hist)
-                if hist_category:
-                    suitable_cars = [car for car, data in CONFIG['cars'].items() if
-                                     hist_category in data.get('categories', [])]
+                if hist['car']:
+                    return hist['car']
+                if hist['category']:
+                    suitable_cars = self.cars_by_category.get(hist['category'], ())
                     if suitable_cars:
                         return random.choice(suitable_cars)
         return None
 
     def _handle_filter_cars(self, price, car_category, context):
         """Обрабатывает фильтрацию автомобилей по цене и категории."""
-        suitable_cars = [
-            car for car, data in CONFIG['cars'].items()
-            if (not price or data['price'] <= price)
-            and (not car_category or car_category in data.get('categories', []))
-        ]
-        recent_cars = [extract_car_name(h) for h in context.user_data.get('history', [])]
-        suitable_cars = [c for c in suitable_cars if c not in recent_cars]
+        mask = np.ones(len(self._car_names), dtype=bool)
+        if price:
+            mask &= self._car_prices <= price
+        if car_category:
+            mask &= self._car_category_mask.get(car_category, False)
+        recent_cars = {h['car'] for h in context.user_data.get('history', []) if h['car']}
+        suitable_cars = [c for c in self._car_names[mask] if c not in recent_cars]
 
         if not suitable_cars:
             conditions = []
@@ -176,7 +264,7 @@ class Bot:
         """Генерирует ответ на основе намерения."""
         car_name = context.user_data.get('current_car')
         last_intent = context.user_data.get('last_intent', '')
-        car_category = extract_car_category(replica)
+        car_category = _category_of(replica)
         price = extract_price(replica)
 
         if intent not in CONFIG['intents']:
@@ -186,12 +274,8 @@ class Bot:
             return None
         answer = random.choice(responses)
 
-        sentiment = analyze_sentiment(replica)
-        sentiment_suffix = ""
-        if sentiment == 'positive':
-            sentiment_suffix = " Рад, что вы в хорошем настроении! 😊"
-        elif sentiment == 'negative':
-            sentiment_suffix = " Кажется, вы не в духе. Давайте подберем авто! 😊"
+        sentiment_suffix = _suffix(_senti(replica), " Рад, что вы в хорошем настроении! 😊",
+                                   " Кажется, вы не в духе. Давайте подберем авто! 😊")
 
         if intent in [Intent.CAR_PRICE.value, Intent.CAR_AVAILABILITY.value, Intent.CAR_INFO.value,
                       Intent.BOOK_TEST_DRIVE.value]:
@@ -215,25 +299,22 @@ class Bot:
                 return f"Укажите цену или категорию для фильтрации.{sentiment_suffix}"
 
         elif intent == Intent.CAR_TYPES.value:
-            categories = random.sample([cat for car in CONFIG['cars'].values() for cat in car.get('categories', [])],
-                                       min(3, len(CONFIG['cars'])))
-            cars = random.sample(list(CONFIG['cars'].keys()), min(2, len(CONFIG['cars'])))
-            answer = f"У нас есть {', '.join(set(categories))} и модели вроде {', '.join(cars)}. Что интересно?{sentiment_suffix}"
+            categories = random.sample(self._unique_categories, min(3, len(self._unique_categories)))
+            cars = random.sample(self._car_keys, min(2, len(self._car_keys)))
+            answer = f"У нас есть {', '.join(categories)} и модели вроде {', '.join(cars)}. Что интересно?{sentiment_suffix}"
             context.user_data['current_car'] = None
 
         elif intent == Intent.COMPARE_CARS.value:
-            car1 = random.choice(list(CONFIG['cars'].keys()))
-            car2 = random.choice([c for c in CONFIG['cars'].keys() if c != car1])
-            answer = answer.replace('[car1]', car1).replace('[car2]', car2)
+            car1 = self._random_car()
+            car2 = self._random_car(exclude=car1)
+            answer = _fill(answer, {'car1': car1, 'car2': car2})
             context.user_data['current_car'] = car1
             answer += f" Что интересует: {car1} или {car2}?{sentiment_suffix}"
 
         elif intent == Intent.YES.value:
             if last_intent == Intent.HELLO.value:
-                categories = random.sample(
-                    [cat for car in CONFIG['cars'].values() for cat in car.get('categories', [])],
-                    min(3, len(CONFIG['cars'])))
-                answer = f"Отлично! У нас есть {', '.join(set(categories))}. Что хотите узнать?{sentiment_suffix}"
+                categories = random.sample(self._unique_categories, min(3, len(self._unique_categories)))
+                answer = f"Отлично! У нас есть {', '.join(categories)}. Что хотите узнать?{sentiment_suffix}"
             elif last_intent in [Intent.CAR_PRICE.value, Intent.CAR_INFO.value, Intent.CAR_AVAILABILITY.value,
                                  Intent.BOOK_TEST_DRIVE.value]:
                 if car_name:
@@ -241,7 +322,7 @@ class Bot:
                 else:
                     answer = f"Назови машину, чтобы я рассказал подробнее!{sentiment_suffix}"
             elif last_intent == Intent.CAR_TYPES.value:
-                cars = random.sample(list(CONFIG['cars'].keys()), min(2, len(CONFIG['cars'])))
+                cars = random.sample(self._car_keys, min(2, len(self._car_keys)))
                 answer = f"У нас есть {', '.join(cars)}. Назови одну, чтобы узнать больше!{sentiment_suffix}"
             elif last_intent == 'offtopic':
                 answer = f"Хорошо, давай продолжим! Хочешь узнать про авто?{sentiment_suffix}"
@@ -254,153 +335,167 @@ class Bot:
             answer = f"Хорошо, какую машину обсудим теперь?{sentiment_suffix}"
 
         if intent in [Intent.HELLO.value, Intent.CAR_TYPES.value] and random.random() < 0.2:
-            ad_car = random.choice([c for c in CONFIG['cars'].keys() if c != car_name])
+            ad_car = self._random_car(exclude=car_name)
             answer += f" Кстати, у нас есть {ad_car} — отличный выбор!{sentiment_suffix}"
 
         context.user_data['last_intent'] = intent
         return answer
 
     def generate_answer(self, replica, context):
-        """Генерирует ответ на основе диалогов."""
-        replica_lemmatized = lemmatize_phrase(replica)
+        """Генерирует ответ на основе диалогов, возвращает (ответ, тип ответа)."""
+        replica_lemmatized = _lem(replica)
         if not replica_lemmatized or not self.answers:
-            return None
+            return None, ResponseType.FAILURE.value
         if not is_meaningful_text(replica):
-            return None
+            return None, ResponseType.FAILURE.value
+        # TfidfVectorizer (norm='l2' по умолчанию) возвращает строки единичной длины и для матрицы,
+        # и для запроса, поэтому скалярное произведение и есть косинусная близость
         replica_vector = self.tfidf_vectorizer.transform([replica_lemmatized])
-        similarities = cosine_similarity(replica_vector, self.tfidf_matrix).flatten()
-        best_idx = similarities.argmax()
-        if similarities[best_idx] > CONFIG['thresholds']['dialogues_similarity']:
+        # Строка 1xN в CSR: ненулевые значения есть только у диалогов с общими токенами
+        similarities = (replica_vector @ self.tfidf_matrix.T).tocsr()
+        # При равных оценках выбираем диалог с меньшим индексом, как argmax по плотному вектору
+        similarities.sort_indices()
+        best_score = 0
+        best_idx = None
+        if similarities.nnz:
+            best_pos = similarities.data.argmax()
+            best_score = similarities.data[best_pos]
+            best_idx = similarities.indices[best_pos]
+        if best_idx is not None and best_score > CONFIG['thresholds']['dialogues_similarity']:
             answer = self.answers[best_idx]
             logger.info(
-                f"Found in dialogues.txt: replica='{replica_lemmatized}', answer='{answer}', similarity={similarities[best_idx]}")
-            sentiment = analyze_sentiment(replica)
-            if sentiment == 'positive':
-                answer += " Рад, что ты в хорошем настроении! 😊"
-            elif sentiment == 'negative':
-                answer += " Кажется, ты не в духе. Может, новый авто поднимет настроение? 😊"
+                f"Found in dialogues.txt: replica='{replica_lemmatized}', answer='{answer}', similarity={best_score}")
+            answer += _suffix(_senti(replica), " Рад, что ты в хорошем настроении! 😊",
+                              " Кажется, ты не в духе. Может, новый авто поднимет настроение? 😊")
             if random.random() < 0.3:
-                ad_car = random.choice(list(CONFIG['cars'].keys()))
+                ad_car = self._random_car()
                 answer += f" Кстати, у нас есть {ad_car} — отличный выбор!"
             context.user_data['last_intent'] = 'offtopic'
-            return answer
+            return answer, ResponseType.GENERATE.value
         logger.info(f"No match in dialogues.txt for replica='{replica_lemmatized}'")
-        return None
+        return None, ResponseType.FAILURE.value
 
     def get_failure_phrase(self, replica):
         """Возвращает фразу при неудачном запросе с учетом тональности."""
-        car_name = random.choice(list(CONFIG['cars'].keys()))
-        answer = random.choice(CONFIG['failure_phrases']).replace('[car_name]', car_name)
-        sentiment = analyze_sentiment(replica)
-        if sentiment == 'positive':
-            answer += " Ты в отличном настроении, давай найдем машину! 😊"
-        elif sentiment == 'negative':
-            answer += " Не переживай, подберем авто для тебя! 😊"
+        car_name = self._random_car()
+        answer = _fill(random.choice(CONFIG['failure_phrases']), {'car_name': car_name})
+        answer += _suffix(_senti(replica), " Ты в отличном настроении, давай найдем машину! 😊",
+                          " Не переживай, подберем авто для тебя! 😊")
         return answer
 
     def _process_none_state(self, replica, context):
-        """Обрабатывает состояние NONE."""
-        car_name = extract_car_name(replica)
+        """Обрабатывает состояние NONE, возвращает (ответ, тип ответа)."""
+        sentiment = _senti(replica)
+        car_name = _car_of(replica)
         if car_name:
             context.user_data['current_car'] = car_name
             context.user_data['state'] = BotState.WAITING_FOR_INTENT.value
-            sentiment = analyze_sentiment(replica)
-            suffix = " Рад, что ты в хорошем настроении! 😊" if sentiment == 'positive' else " Кажется, ты не в духе. Давай найдем авто? 😊" if sentiment == 'negative' else ""
-            return f"Вы имеете в виду {car_name}? Хотите узнать цену, характеристики или тест-драйв?{suffix}"
+            suffix = _suffix(sentiment, " Рад, что ты в хорошем настроении! 😊", " Кажется, ты не в духе. Давай найдем авто? 😊")
+            return f"Вы имеете в виду {car_name}? Хотите узнать цену, характеристики или тест-драйв?{suffix}", ResponseType.INTENT.value
 
-        car_category = extract_car_category(replica)
+        car_category = _category_of(replica)
         if car_category:
-            suitable_cars = [car for car, data in CONFIG['cars'].items() if car_category in data.get('categories', [])]
+            suitable_cars = self.cars_by_category.get(car_category, ())
             if suitable_cars:
                 car_name = random.choice(suitable_cars)
                 context.user_data['current_car'] = car_name
                 context.user_data['state'] = BotState.WAITING_FOR_INTENT.value
-                sentiment = analyze_sentiment(replica)
-                suffix = " Ты в отличном настроении, давай продолжим! 😊" if sentiment == 'positive' else " Не грусти, найдем машину! 😊" if sentiment == 'negative' else ""
-                return f"Из {car_category} есть {car_name}. Хотите узнать цену, характеристики или тест-драйв?{suffix}"
-            sentiment = analyze_sentiment(replica)
-            suffix = " В хорошем настроении? Давай попробуем другую категорию! 😊" if sentiment == 'positive' else " Не переживай, попробуем другую категорию! 😊" if sentiment == 'negative' else ""
-            return f"У нас нет машин в категории {car_category}. Попробуйте другую категорию!{suffix}"
+                suffix = _suffix(sentiment, " Ты в отличном настроении, давай продолжим! 😊", " Не грусти, найдем машину! 😊")
+                return f"Из {car_category} есть {car_name}. Хотите узнать цену, характеристики или тест-драйв?{suffix}", ResponseType.INTENT.value
+            suffix = _suffix(sentiment, " В хорошем настроении? Давай попробуем другую категорию! 😊", " Не переживай, попробуем другую категорию! 😊")
+            return f"У нас нет машин в категории {car_category}. Попробуйте другую категорию!{suffix}", ResponseType.INTENT.value
 
         intent = self.classify_intent(replica)
         if intent:
-            return self.get_answer_by_intent(intent, replica, context)
+            return self.get_answer_by_intent(intent, replica, context), ResponseType.INTENT.value
 
-        return self.generate_answer(replica, context) or self.get_failure_phrase(replica)
+        answer, response_type = self.generate_answer(replica, context)
+        if answer:
+            return answer, response_type
+        return self.get_failure_phrase(replica), ResponseType.FAILURE.value
 
     def _process_waiting_for_car(self, replica, context):
-        """Обрабатывает состояние WAITING_FOR_CAR."""
-        car_name = extract_car_name(replica)
+        """Обрабатывает состояние WAITING_FOR_CAR, возвращает (ответ, тип ответа)."""
+        sentiment = _senti(replica)
+        car_name = _car_of(replica)
         if car_name:
             context.user_data['current_car'] = car_name
             context.user_data['state'] = BotState.WAITING_FOR_INTENT.value
-            sentiment = analyze_sentiment(replica)
-            suffix = " Отличное настроение, да? 😊" if sentiment == 'positive' else " Давай найдем что-то подходящее! 😊" if sentiment == 'negative' else ""
-            return f"Вы имеете в виду {car_name}? Хотите узнать цену, характеристики или тест-драйв?{suffix}"
-        car_category = extract_car_category(replica)
+            suffix = _suffix(sentiment, " Отличное настроение, да? 😊", " Давай найдем что-то подходящее! 😊")
+            return f"Вы имеете в виду {car_name}? Хотите узнать цену, характеристики или тест-драйв?{suffix}", ResponseType.INTENT.value
+        car_category = _category_of(replica)
         if car_category:
-            suitable_cars = [car for car, data in CONFIG['cars'].items() if car_category in data.get('categories', [])]
+            suitable_cars = self.cars_by_category.get(car_category, ())
             if suitable_cars:
                 car_name = random.choice(suitable_cars)
                 context.user_data['current_car'] = car_name
                 context.user_data['state'] = BotState.WAITING_FOR_INTENT.value
-                sentiment = analyze_sentiment(replica)
-                suffix = " В хорошем расположении духа? 😊" if sentiment == 'positive' else " Не грусти, найдем авто! 😊" if sentiment == 'negative' else ""
-                return f"Из {car_category} есть {car_name}. Хотите узнать цену, характеристики или тест-драйв?{suffix}"
-        sentiment = analyze_sentiment(replica)
-        suffix = " Отлично, давай продолжим! 😊" if sentiment == 'positive' else " Не переживай, уточним! 😊" if sentiment == 'negative' else ""
-        return f"Пожалуйста, уточните название машины или категорию.{suffix}"
+                suffix = _suffix(sentiment, " В хорошем расположении духа? 😊", " Не грусти, найдем авто! 😊")
+                return f"Из {car_category} есть {car_name}. Хотите узнать цену, характеристики или тест-драйв?{suffix}", ResponseType.INTENT.value
+        suffix = _suffix(sentiment, " Отлично, давай продолжим! 😊", " Не переживай, уточним! 😊")
+        return f"Пожалуйста, уточните название машины или категорию.{suffix}", ResponseType.FAILURE.value
 
     def _process_waiting_for_intent(self, replica, context):
-        """Обрабатывает состояние WAITING_FOR_INTENT."""
-        car_name = extract_car_name(replica)
+        """Обрабатывает состояние WAITING_FOR_INTENT, возвращает (ответ, тип ответа)."""
+        last_intent = context.user_data.get('last_intent', '')
+        sentiment = _senti(replica)
+        car_name = _car_of(replica)
         if car_name and car_name in CONFIG['cars']:
             context.user_data['current_car'] = car_name
         else:
-            car_name = context.user_data.get('current_car', 'машину')
+            car_name = context.user_data.get('current_car') or 'машину'
 
         intent = self.classify_intent(replica)
         if intent in [Intent.CAR_PRICE.value, Intent.CAR_AVAILABILITY.value, Intent.CAR_INFO.value,
                       Intent.BOOK_TEST_DRIVE.value]:
             context.user_data['state'] = BotState.NONE.value
-            return self._get_car_response(intent, car_name, replica, context)
+            return self._get_car_response(intent, car_name, replica, context), ResponseType.INTENT.value
         if intent == Intent.YES.value:
             if last_intent == Intent.HELLO.value:
-                categories = random.sample(
-                    [cat for car in CONFIG['cars'].values() for cat in car.get('categories', [])],
-                    min(3, len(CONFIG['cars'])))
-                answer = f"Отлично! У нас есть {', '.join(set(categories))}. Что хотите узнать?{sentiment_suffix}"
+                context.user_data['state'] = BotState.NONE.value
+                categories = random.sample(self._unique_categories, min(3, len(self._unique_categories)))
+                suffix = _suffix(sentiment, " Рад, что вы в хорошем настроении! 😊",
+                                 " Кажется, вы не в духе. Давайте подберем авто! 😊")
+                return f"Отлично! У нас есть {', '.join(categories)}. Что хотите узнать?{suffix}", ResponseType.INTENT.value
             elif last_intent in [Intent.CAR_PRICE.value, Intent.CAR_INFO.value, Intent.CAR_AVAILABILITY.value,
                                  Intent.BOOK_TEST_DRIVE.value]:
-                if car_name:
+                if car_name in CONFIG['cars']:
                     context.user_data['state'] = BotState.NONE.value
-                    sentiment = analyze_sentiment(replica)
-                    suffix = " Рад твоему настроению! 😊" if sentiment == 'positive' else " Давай поднимем настроение! 😊" if sentiment == 'negative' else ""
-                    return f"Цена на {car_name} — {CONFIG['cars'][car_name]['price']} рублей. Что ещё интересует?{suffix}"
+                    suffix = _suffix(sentiment, " Рад твоему настроению! 😊", " Давай поднимем настроение! 😊")
+                    return f"Цена на {car_name} — {CONFIG['cars'][car_name]['price']} рублей. Что ещё интересует?{suffix}", ResponseType.INTENT.value
         if intent == Intent.NO.value:
             context.user_data['current_car'] = None
             context.user_data['state'] = BotState.NONE.value
-            sentiment = analyze_sentiment(replica)
-            suffix = " Отлично, продолжаем! 😊" if sentiment == 'positive' else " Не грусти, найдем другое! 😊" if sentiment == 'negative' else ""
-            return f"Хорошо, какую машину обсудим теперь?{suffix}"
-        sentiment = analyze_sentiment(replica)
-        suffix = " В хорошем настроении? 😊" if sentiment == 'positive' else " Не переживай, найдем что-то подходящее! 😊" if sentiment == 'negative' else ""
-        return f"Что хотите узнать про {car_name}: цену, характеристики или тест-драйв?{suffix}"
-
-    def process(self, replica, context):
-        """Обрабатывает запрос пользователя."""
+            suffix = _suffix(sentiment, " Отлично, продолжаем! 😊", " Не грусти, найдем другое! 😊")
+            return f"Хорошо, какую машину обсудим теперь?{suffix}", ResponseType.INTENT.value
+        suffix = _suffix(sentiment, " В хорошем настроении? 😊", " Не переживай, найдем что-то подходящее! 😊")
+        response_type = ResponseType.INTENT.value if intent else ResponseType.FAILURE.value
+        return f"Что хотите узнать про {car_name}: цену, характеристики или тест-драйв?{suffix}", response_type
+
+    async def process(self, replica, context):
+        """Обрабатывает запрос пользователя, не блокируя цикл событий."""
+        # Весь синхронный конвейер (лемматизация, классификация, TF-IDF) выполняется одним заданием в потоке
+        return await asyncio.to_thread(self._process, replica, context)
+
+    def _process(self, replica, context):
+        """Синхронно обрабатывает запрос пользователя."""
         stats = Stats(context)
         if not is_meaningful_text(replica):
             answer = self.get_failure_phrase(replica)
-            self._update_context(context, replica, answer)
+            # Латинские названия («Kia Rio») не считаются осмысленным текстом, но машина в них есть
+            car_name = _car_of(replica)
+            car_category = _category_of(replica)
+            self._update_context(context, replica, answer, car_name=car_name, car_category=car_category)
             stats.add(ResponseType.FAILURE.value, replica, answer, context)
             return answer
 
+        # Результаты попадают в кэши и переиспользуются обработчиками состояний
         price = extract_price(replica)
-        car_category = extract_car_category(replica)
+        car_name = _car_of(replica)
+        car_category = _category_of(replica)
         if price:
             answer = self._handle_filter_cars(price, car_category, context)
-            self._update_context(context, replica, answer, Intent.FILTER_CARS.value)
+            self._update_context(context, replica, answer, Intent.FILTER_CARS.value, car_name, car_category)
             stats.add(ResponseType.INTENT.value, replica, answer, context)
             return answer
 
@@ -409,55 +504,65 @@ class Bot:
             f"Processing: replica='{replica}', state='{state}', last_intent='{context.user_data.get('last_intent')}'")
 
         if state == BotState.WAITING_FOR_CAR.value:
-            answer = self._process_waiting_for_car(replica, context)
+            answer, response_type = self._process_waiting_for_car(replica, context)
         elif state == BotState.WAITING_FOR_INTENT.value:
-            answer = self._process_waiting_for_intent(replica, context)
+            answer, response_type = self._process_waiting_for_intent(replica, context)
         else:
-            answer = self._process_none_state(replica, context)
+            answer, response_type = self._process_none_state(replica, context)
 
-        self._update_context(context, replica, answer)
-        stats.add(ResponseType.INTENT.value if self.classify_intent(
-                      replica) else ResponseType.GENERATE.value if 'dialogues.txt' in answer else ResponseType.FAILURE.value,
-                  replica, answer, context)
+        self._update_context(context, replica, answer, car_name=car_name, car_category=car_category)
+        stats.add(response_type, replica, answer, context)
         return answer
 
 # Голос в текст
-def voice_to_text(voice_file):
+def voice_to_text(voice_data):
     recognizer = sr.Recognizer()
+    # Ограничиваем сам HTTP-запрос к Google: поток-исполнитель не должен зависать
+    recognizer.operation_timeout = VOICE_TIMEOUT
     try:
-        import signal
-        def signal_handler(signum, frame):
-            raise TimeoutError("Speech recognition timed out")
-
-        signal.signal(signal.SIGALRM, signal_handler)
-        signal.alarm(5)  # Таймаут 5 секунд
-        audio = AudioSegment.from_ogg(voice_file)
-        audio.export('voice.wav', format='wav')
-        with sr.AudioFile('voice.wav') as source:
+        audio = AudioSegment.from_ogg(BytesIO(voice_data))
+        wav = BytesIO()
+        audio.export(wav, format='wav')
+        wav.seek(0)
+        with sr.AudioFile(wav) as source:
             audio_data = recognizer.record(source)
         text = recognizer.recognize_google(audio_data, language='ru-RU')
         return text
-    except (sr.UnknownValueError, sr.RequestError, TimeoutError, Exception) as e:
+    except (sr.UnknownValueError, sr.RequestError, Exception) as e:
         logger.error(f"Ошибка распознавания голоса: {e}\n{traceback.format_exc()}")
         return None
-    finally:
-        signal.alarm(0)
-        if os.path.exists('voice.wav'):
-            os.remove('voice.wav')
+
+# Очистка кэша синтеза: удаляем давно не использованные файлы сверх лимита
+def _prune_tts_cache():
+    files = sorted(TTS_CACHE_DIR.glob('*.mp3'), key=lambda path: path.stat().st_mtime)
+    for path in files[:max(0, len(files) - CONFIG['tts_cache_limit'])]:
+        path.unlink(missing_ok=True)
 
 # Текст в голос
 def text_to_voice(text):
     if not text:
         return None
     try:
+        TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        voice_file = TTS_CACHE_DIR / f"{hashlib.sha1(text.encode('utf-8')).hexdigest()}.mp3"
+        if voice_file.exists():
+            voice_file.touch()
+            return voice_file
         tts = gTTS(text=text, lang='ru')
-        voice_file = 'response.mp3'
-        tts.save(voice_file)
+        # Уникальный временный файл: одинаковый текст может синтезироваться в нескольких чатах одновременно
+        with tempfile.NamedTemporaryFile(dir=TTS_CACHE_DIR, suffix='.tmp', delete=False) as tmp_file:
+            tts.write_to_fp(tmp_file)
+        os.replace(tmp_file.name, voice_file)
+        _prune_tts_cache()
         return voice_file
     except Exception as e:
         logger.error(f"Ошибка синтеза речи: {e}\n{traceback.format_exc()}")
         return None
 
+# Блокировка чата: сообщения одного чата обрабатываются и получают ответ строго по очереди
+def _chat_lock(context):
+    return context.chat_data.setdefault('lock', asyncio.Lock())
+
 # Telegram-обработчики
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = CONFIG['start_message']
@@ -489,50 +594,64 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['last_bot_response'] = answer
         await update.message.reply_text(answer)
         return
-    bot = context.bot_data.setdefault('bot', Bot())
-    answer = bot.process(user_text, context)
-    await update.message.reply_text(answer)
+    bot = context.bot_data['bot']
+    async with _chat_lock(context):
+        answer = await bot.process(user_text, context)
+        await update.message.reply_text(answer)
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     voice = update.message.voice
-    bot = context.bot_data.setdefault('bot', Bot())
-    try:
-        voice_file = await context.bot.get_file(voice.file_id)
-        await voice_file.download_to_drive('voice.ogg')
-        text = voice_to_text('voice.ogg')
-        if text:
-            answer = bot.process(text, context)
-            voice_response = text_to_voice(answer)
-            if voice_response:
-                with open(voice_response, 'rb') as audio:
-                    await update.message.reply_voice(audio)
-                os.remove(voice_response)
+    bot = context.bot_data['bot']
+    # Голосовое сообщение держит только блокировку своего чата: другие чаты обрабатываются параллельно
+    async with _chat_lock(context):
+        try:
+            voice_file = await context.bot.get_file(voice.file_id)
+            voice_data = await voice_file.download_as_bytearray()
+            try:
+                # Распознавание блокирующее: выполняем в отдельном потоке, чтобы не останавливать цикл событий.
+                # Запрос ограничен VOICE_TIMEOUT внутри voice_to_text, здесь — внешняя страховка с запасом на конвертацию
+                text = await asyncio.wait_for(asyncio.to_thread(voice_to_text, bytes(voice_data)),
+                                              timeout=VOICE_TIMEOUT * 2)
+            except asyncio.TimeoutError:
+                logger.error("Ошибка распознавания голоса: превышено время ожидания")
+                text = None
+            if text:
+                answer = await bot.process(text, context)
+                # Синтез (HTTP-запрос к gTTS) и очистка кэша блокирующие — выполняем в потоке
+                voice_response = await asyncio.to_thread(text_to_voice, answer)
+                if voice_response:
+                    with open(voice_response, 'rb') as audio:
+                        await update.message.reply_voice(audio)
+                else:
+                    await update.message.reply_text(answer)
             else:
+                answer = "Не удалось распознать голос. Попробуйте ещё раз."
+                context.user_data['last_bot_response'] = answer
                 await update.message.reply_text(answer)
-        else:
-            answer = "Не удалось распознать голос. Попробуйте ещё раз."
+        except Exception as e:
+            logger.error(f"Ошибка обработки голосового сообщения: {e}\n{traceback.format_exc()}")
+            answer = "Произошла ошибка. Попробуйте снова."
             context.user_data['last_bot_response'] = answer
             await update.message.reply_text(answer)
-    except Exception as e:
-        logger.error(f"Ошибка обработки голосового сообщения: {e}\n{traceback.format_exc()}")
-        answer = "Произошла ошибка. Попробуйте снова."
-        context.user_data['last_bot_response'] = answer
-        await update.message.reply_text(answer)
-    finally:
-        if os.path.exists('voice.ogg'):
-            os.remove('voice.ogg')
 
 def run_bot():
     if not TOKEN:
         raise ValueError("TELEGRAM_TOKEN не найден")
-    app = ApplicationBuilder().token(TOKEN).build()
+    # Цикл событий создаёт PTB, поэтому подменяем политику, а не используем uvloop.run
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    app = ApplicationBuilder().token(TOKEN).concurrent_updates(CONCURRENT_UPDATES).build()
+    app.bot_data['bot'] = Bot()
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
     logger.info("Бот запускается...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        app.run_webhook(listen='0.0.0.0', port=WEBHOOK_PORT, url_path=TOKEN,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}")
+    else:
+        app.run_polling()
 
 if __name__ == '__main__':
     run_bot()
\ No newline at end of file
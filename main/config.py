@@ -371,6 +371,20 @@ CONFIG = {
         'dialogues_similarity': 0.5,
         'intent_score': 0.6,
         'fuzzy_match_car': 85,
+        # Порог decision_function LinearSVC для запасной классификации (см. intent_classifier_fallback).
+        # Значение — знаковое расстояние до разделяющей гиперплоскости в единицах отступа: 0 — граница класса,
+        # 1 — край отступа, за который hinge loss выталкивает обучающие примеры. 0.5 — середина отступа:
+        # реплика явно на стороне класса, но ближе к нему, чем типичный обучающий пример. Значение выбрано
+        # из этой геометрии, а не подобрано на данных; при включении флага его стоит проверить на реальных репликах
+        'intent_classifier_margin': 0.5,
     },
+    # Запасная классификация намерений моделью sklearn (models/intent_*.pkl загружаются только при True):
+    # вызывается, если ни один пример не прошел порог intent_score, и принимается, только если значение
+    # decision_function для лучшего класса не ниже intent_classifier_margin. Иначе намерение не найдено,
+    # и бот отвечает из диалогов или фразой неудачи
+    'intent_classifier_fallback': False,
+    # Намерения, которые распознаются по точному совпадению реплики с примером, без классификации
+    'fast_intents': ['hello', 'bye', 'yes', 'no'],
     'history_limit': 5,
+    'tts_cache_limit': 500,
 }
\ No newline at end of file
@@ -1,6 +1,6 @@
 # ./app/train_dialogues_model.py
 
-import pickle
+import joblib
 from sklearn.feature_extraction.text import TfidfVectorizer
 from utils import clear_phrase, lemmatize_phrase, logger
 
@@ -37,11 +37,8 @@ logger.info("TF-IDF модель обучена")
 
 # Сохранение модели
 logger.info("Сохранение модели...")
-with open('models/dialogues_vectorizer.pkl', 'wb') as f:
-    pickle.dump(tfidf_vectorizer, f)
-with open('models/dialogues_matrix.pkl', 'wb') as f:
-    pickle.dump(tfidf_matrix, f)
-with open('models/dialogues_answers.pkl', 'wb') as f:
-    pickle.dump(answers, f)
+joblib.dump(tfidf_vectorizer, 'models/dialogues_vectorizer.pkl', compress=0)
+joblib.dump(tfidf_matrix, 'models/dialogues_matrix.pkl', compress=0)
+joblib.dump(answers, 'models/dialogues_answers.pkl', compress=0)
 
 logger.info("Модель для dialogues.txt обучена и сохранена в ./models/")
\ No newline at end of file
@@ -1,6 +1,6 @@
 # ./app/train_intent_model.py
 
-import pickle
+import joblib
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.svm import LinearSVC
 from config import CONFIG
@@ -28,9 +28,7 @@ clf.fit(X_train_vectorized, y_train)
 logger.info("Модель намерений обучена")
 
 # Сохранение модели
-with open('models/intent_model.pkl', 'wb') as f:
-    pickle.dump(clf, f)
-with open('models/intent_vectorizer.pkl', 'wb') as f:
-    pickle.dump(vectorizer, f)
+joblib.dump(clf, 'models/intent_model.pkl', compress=0)
+joblib.dump(vectorizer, 'models/intent_vectorizer.pkl', compress=0)
 
 logger.info("Модель намерений сохранена в ./models/")
\ No newline at end of file